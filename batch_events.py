@@ -0,0 +1,90 @@
+"""
+Event log of incremental changes to batch records.
+
+Instead of republishing the whole batch record for every change, each change is
+published as a small event ({"op": ..., "data": ...}) under the stream key
+'<batch_key>:events'. Full records are published under both the batch key and
+its events key, so listing the events key returns records and events in stream
+order. The current state of a batch is its latest full record with the events
+published after it folded in, in publication order.
+"""
+
+EVENTS_KEY_SUFFIX = ':events'
+
+# Event ops that append an entry to a list field of the batch record
+APPEND_OPS = {
+    'qc_test': 'qc_tests',
+    'deviation': 'deviations',
+    'capa': 'CAPA',
+    'oos': 'OOS_investigations'
+}
+
+# Event ops that replace a single field of the batch record
+SET_OPS = {
+    'release_status': 'release_status',
+    'expiration_date': 'expiration_date'
+}
+
+def events_key(batch_key):
+    """
+    Returns the stream key under which the events of a batch are published.
+    """
+    return batch_key + EVENTS_KEY_SUFFIX
+
+def record_keys(batch_key):
+    """
+    Returns the stream keys a full batch record is published under.
+    """
+    return [batch_key, events_key(batch_key)]
+
+def is_events_key(key):
+    """
+    Returns True if the stream key holds batch events rather than full records.
+    """
+    return key.endswith(EVENTS_KEY_SUFFIX)
+
+def batch_key_of(key):
+    """
+    Returns the batch key an events stream key belongs to.
+    """
+    return key[:-len(EVENTS_KEY_SUFFIX)]
+
+def make_event(op, data):
+    """
+    Builds the payload published for a single change to a batch.
+    """
+    return {"op": op, "data": data}
+
+def apply_event(batch_record, event):
+    """
+    Returns a new batch record with the event applied; the input record is not modified.
+    Unknown ops are ignored so older readers tolerate newer event types.
+    """
+    op = event.get('op')
+    if op in APPEND_OPS:
+        field = APPEND_OPS[op]
+        batch_record = dict(batch_record)
+        batch_record[field] = batch_record.get(field, []) + [event['data']]
+    elif op in SET_OPS:
+        batch_record = dict(batch_record)
+        batch_record[SET_OPS[op]] = event['data']
+    return batch_record
+
+def fold_events(batch_record, events):
+    """
+    Folds a sequence of events, oldest first, into a batch record; the input record is
+    not modified. Each list field is copied at most once, however many events append to it.
+    """
+    batch_record = dict(batch_record)
+    copied_fields = set()
+    for event in events:
+        op = event.get('op')
+        if op in APPEND_OPS:
+            field = APPEND_OPS[op]
+            if field not in copied_fields:
+                batch_record[field] = list(batch_record.get(field, []))
+                copied_fields.add(field)
+            batch_record[field].append(event['data'])
+        elif op in SET_OPS:
+            batch_record[SET_OPS[op]] = event['data']
+    return batch_record
@@ -12,7 +12,7 @@ Main Features:
 
 Requirements:
 - Multichain RPC credentials stored in a '.env' file (RPC_USER, RPC_PASSWORD, RPC_HOST, RPC_PORT).
-- External dependencies: `requests`, `dotenv`, `binascii`, `data_fingerprint`, `hashlib`.
+- External dependencies: `requests`, `dotenv`, `orjson`, `msgpack`, `data_fingerprint`, `hashlib`.
 
 data_fingerprint is avaliable from the github repository https://github.com/chriswilson2020/data_fingerprint/
 
@@ -104,28 +104,60 @@ Notes:
 """
 
 import os
+import re
+import copy
 import sys
 import json
-import json
-import binascii
+import atexit
+import itertools
+import asyncio
+import orjson
 import requests
+import batch_events
+import record_codec
+import index_batches
 import data_fingerprint
-from hashlib import sha256
+from hashlib import sha256, file_digest
 from dotenv import load_dotenv
-from datetime import datetime
-
-# Function to connect to a Multichain node
-def connect_to_multichain(method, params=None):
+from datetime import date
+from functools import lru_cache
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+# Number of RPC calls rpc_many keeps in flight at once
+_RPC_WORKERS = 16
+
+# Shared HTTP session so consecutive RPC calls reuse the same keep-alive connection.
+# Only failures to connect are retried: every RPC is a POST, and a call such as publish
+# must not be re-sent once the node may have received it.
+_SESSION = requests.Session()
+_SESSION.mount('http://', HTTPAdapter(
+    pool_connections=4,
+    pool_maxsize=_RPC_WORKERS,
+    max_retries=Retry(total=3, backoff_factor=0.2)
+))
+atexit.register(_SESSION.close)
+
+# Load the RPC settings once and reuse them for every subsequent call
+@lru_cache(maxsize=1)
+def _init_rpc():
     # Load environment variables from .env file
     load_dotenv('blockchain.env')
     rpc_user = os.getenv('RPC_USER')
     rpc_password = os.getenv('RPC_PASSWORD')
     rpc_host = os.getenv('RPC_HOST')
     rpc_port = os.getenv('RPC_PORT')
-    
+
     # Construct the URL for the RPC connection
     url = f'http://{rpc_user}:{rpc_password}@{rpc_host}:{rpc_port}'
     headers = {'content-type': 'application/json'}
+    return url, headers
+
+# Function to connect to a Multichain node
+def connect_to_multichain(method, params=None):
+    url, headers = _init_rpc()
     payload = {
         "method": method,
         "params": params if params else [],
@@ -133,30 +165,143 @@ def connect_to_multichain(method, params=None):
         "id": 1
     }
 
-    response = requests.post(url, data=json.dumps(payload), headers=headers)
-    return response.json()
+    response = _SESSION.post(url, json=payload, headers=headers)
+    # Parse the body bytes directly; response.json() would first decode them to a str
+    return orjson.loads(response.content)
+
+# Number of RPC calls to send per batched HTTP request
+_BATCH_CHUNK_SIZE = 50
+
+# Item count that makes liststreamkeyitems return every item under a key
+_ALL_ITEMS = 2**31 - 1
+
+# Function to send several RPC calls to a Multichain node in one HTTP request
+def connect_to_multichain_batch(calls):
+    url, headers = _init_rpc()
+    payload = [
+        {"jsonrpc": "2.0", "id": i, "method": method, "params": params if params else []}
+        for i, (method, params) in enumerate(calls)
+    ]
+
+    response = _SESSION.post(url, json=payload, headers=headers)
+    results = orjson.loads(response.content)
+    if not isinstance(results, list):
+        # The node rejected the batch as a whole, so issue the calls individually
+        return rpc_many(calls)
+
+    # The node may answer a batch in any order, so line the responses up by id
+    return sorted(results, key=lambda r: r['id'])
+
+# Function to run several RPC calls concurrently over the shared session, preserving order
+def rpc_many(calls):
+    with ThreadPoolExecutor(max_workers=_RPC_WORKERS) as executor:
+        futures = [executor.submit(connect_to_multichain, method, params) for method, params in calls]
+        return [future.result() for future in futures]
+
+# Coroutine variant of connect_to_multichain for use from an event loop (e.g. Jupyter)
+async def arpc(method, params=None):
+    return await asyncio.to_thread(connect_to_multichain, method, params)
+
+# Coroutine variant of rpc_many; the calls run concurrently and results keep call order
+async def arpc_many(calls):
+    return await asyncio.gather(*[arpc(method, params) for method, params in calls])
+
+# Function to get the hex data of a stream item. Items larger than the node's maxshowndata
+# setting are returned as a {"txid", "vout"} reference that has to be fetched separately.
+def _item_data(item):
+    data = item['data']
+    if isinstance(data, dict) and 'txid' in data:
+        data = connect_to_multichain('gettxoutdata', [data['txid'], data['vout']])['result']
+    return data
+
+# Function to yield the latest record published under each key of a stream, decoding
+# one chunk of keys at a time so the whole stream is never held in memory
+def iter_latest_records(stream_name):
+    result = connect_to_multichain('liststreamkeys', [stream_name])
+    if not result or not result.get('result'):
+        return
 
-# Function to hash and add data to the blockchain
+    # Event keys only hold incremental changes, not full records
+    keys = [entry['key'] for entry in result['result'] if not batch_events.is_events_key(entry['key'])]
+
+    # Fetch only the tail item of each key, _BATCH_CHUNK_SIZE keys per HTTP request
+    for start in range(0, len(keys), _BATCH_CHUNK_SIZE):
+        chunk = keys[start:start + _BATCH_CHUNK_SIZE]
+        calls = [('liststreamkeyitems', [stream_name, key, False, 1]) for key in chunk]
+        for response in connect_to_multichain_batch(calls):
+            if response.get('result'):
+                # Decode the hex data of the latest item
+                try:
+                    batch_record = record_codec.decode_record(_item_data(response['result'][-1]))
+                except (TypeError, ValueError):
+                    # Not a batch record (e.g. a bare hash published by put_hash_on_blockchain)
+                    continue
+                if isinstance(batch_record, dict):
+                    yield batch_record
+
+# Function to hash and add data (str or bytes) to the blockchain
 def put_hash_on_blockchain(data):
-    # Hash the data
-    hash_object = sha256(data.encode('utf-8')).hexdigest()
+    # Hash the data, only encoding it if it is not already bytes
+    if isinstance(data, str):
+        data = data.encode('utf-8')
+    hash_object = sha256(data).hexdigest()
     print(f'Hash: {hash_object}')
 
     # Create a transaction to add the hash to the blockchain
     result = connect_to_multichain('publish', ['root', 'Testing', hash_object])
     return result
 
+# Function to hash a file and add the hash to the blockchain
+def put_hash_on_blockchain_file(file_path):
+    # Stream the file straight into the SHA-256 state without building the contents in Python.
+    # hashlib is backed by OpenSSL, which uses the CPU's SHA extensions where available.
+    with open(file_path, 'rb') as f:
+        hash_object = file_digest(f, 'sha256').hexdigest()
+    print(f'Hash: {hash_object}')
+
+    # Create a transaction to add the hash to the blockchain
+    result = connect_to_multichain('publish', ['root', 'Testing', hash_object])
+    return result
+
+# Payloads above this many bytes are uploaded through a binary cache before publishing
+_BINARY_CACHE_THRESHOLD = 256 * 1024
+
+# Number of hex characters sent per appendbinarycache call
+_BINARY_CACHE_CHUNK = 128 * 1024
+
+# Function to publish a large hex payload through a Multichain binary cache
+def _publish_via_binary_cache(stream_name, key, record_hex):
+    cache_id = connect_to_multichain('createbinarycache')['result']
+    try:
+        # Upload the payload in chunks, so no single RPC body has to carry all of it
+        for start in range(0, len(record_hex), _BINARY_CACHE_CHUNK):
+            connect_to_multichain('appendbinarycache', [cache_id, record_hex[start:start + _BINARY_CACHE_CHUNK]])
+
+        return connect_to_multichain('publish', [stream_name, key, {"cache": cache_id}])
+    finally:
+        connect_to_multichain('deletebinarycache', [cache_id])
+
 def publish_json_to_blockchain(stream_name, key, json_data):
-    # Convert JSON object to string
-    json_string = json.dumps(json_data)
+    # Serialize the record to MessagePack in hexadecimal format
+    record_hex = record_codec.encode_record(json_data)
 
-    # Convert the string to hexadecimal format
-    json_hex = binascii.hexlify(json_string.encode('utf-8')).decode('utf-8')
+    # Publish the record in hex format to the blockchain
+    if len(record_hex) // 2 > _BINARY_CACHE_THRESHOLD:
+        result = _publish_via_binary_cache(stream_name, key, record_hex)
+    else:
+        result = connect_to_multichain('publish', [stream_name, key, record_hex])
 
-    # Publish the JSON in hex format to the blockchain
-    result = connect_to_multichain('publish', [stream_name, key, json_hex])
+    # Drop the cached copy of the batch this item belongs to
+    for item_key in key if isinstance(key, list) else [key]:
+        batch_key = batch_events.batch_key_of(item_key) if batch_events.is_events_key(item_key) else item_key
+        _LATEST_CACHE.pop((stream_name, batch_key), None)
     return result
 
+# Function to publish a single change to a batch as an event instead of republishing the whole record
+def publish_batch_event(stream_name, batch_key, op, data):
+    event = batch_events.make_event(op, data)
+    return publish_json_to_blockchain(stream_name, batch_events.events_key(batch_key), event)
+
 def generate_fingerprints(file_path, data_fingerprint):
     # Order-Dependent Fingerprint
     fingerprint_dep = data_fingerprint.process_file_with_order_dependent_fingerprint(file_path)
@@ -166,23 +311,99 @@ def generate_fingerprints(file_path, data_fingerprint):
 
     return fingerprint_dep, fingerprint_indep
 
-def get_latest_json_from_blockchain(stream_name, key):
-    # Retrieve the latest item associated with the given key
-    result = connect_to_multichain('liststreamkeyitems', [stream_name, key])
-
-    if result and 'result' in result and len(result['result']) > 0:
-        # Get the latest entry (last one in the list)
-        json_hex = result['result'][-1]['data']
+# Most recently read batch records, keyed by (stream, key), least recently used first.
+# Each entry holds the txids of the newest record and event it was built from.
+_LATEST_CACHE = OrderedDict()
+_LATEST_CACHE_SIZE = 256
+
+# Function to get the txid of the newest item in a liststreamkeyitems result
+def _tail_txid(result):
+    items = result.get('result') if result else None
+    return items[-1].get('txid') if items else None
+
+# Function to get the items of an events key listing published after the given full record.
+# Full records are also published under the events key, so the record's position there marks
+# which events it already supersedes. Records published before that are not listed there; all
+# events then follow them.
+def _events_after(event_items, record_txid, batch_key):
+    for position, item in enumerate(event_items):
+        if item.get('txid') == record_txid:
+            event_items = event_items[position + 1:]
+            break
+    # Skip any full records listed under the events key
+    return [item for item in event_items if batch_key not in (item.get('keys') or [])]
 
-        # Convert hex back to string
-        json_string = binascii.unhexlify(json_hex).decode('utf-8')
-
-        # Parse string as JSON
-        json_data = json.loads(json_string)
+def get_latest_json_from_blockchain(stream_name, key):
+    cache_key = (stream_name, key)
+    events_key = batch_events.events_key(key)
+
+    cached = _LATEST_CACHE.get(cache_key)
+    if cached is not None:
+        # Peek at the newest item under both keys; if neither moved (e.g. another process
+        # published meanwhile) the cached record is still current
+        record_tail, events_tail = connect_to_multichain_batch([
+            ('liststreamkeyitems', [stream_name, key, False, 1]),
+            ('liststreamkeyitems', [stream_name, events_key, False, 1])
+        ])
+        if (_tail_txid(record_tail), _tail_txid(events_tail)) == cached[0]:
+            _LATEST_CACHE.move_to_end(cache_key)
+            return copy.deepcopy(cached[1])
+
+    # Retrieve the latest full record and all events for the given key in one round trip
+    record_result, events_result = connect_to_multichain_batch([
+        ('liststreamkeyitems', [stream_name, key, False, 1]),
+        ('liststreamkeyitems', [stream_name, events_key, False, _ALL_ITEMS, 0])
+    ])
+
+    if record_result and record_result.get('result'):
+        # Get the latest entry (last one in the list) and convert hex back to the record
+        json_hex = _item_data(record_result['result'][-1])
+        json_data = record_codec.decode_record(json_hex)
+
+        # Fold in the changes published as events after this record
+        event_items = _events_after(events_result.get('result') or [], _tail_txid(record_result), key)
+        events = (record_codec.decode_record(_item_data(item)) for item in event_items)
+        json_data = batch_events.fold_events(json_data, events)
+
+        # Cache a private copy so callers are free to modify the record they get back
+        _LATEST_CACHE[cache_key] = ((_tail_txid(record_result), _tail_txid(events_result)), copy.deepcopy(json_data))
+        _LATEST_CACHE.move_to_end(cache_key)
+        if len(_LATEST_CACHE) > _LATEST_CACHE_SIZE:
+            _LATEST_CACHE.popitem(last=False)
         return json_data
     else:
         return None
 
+# Function to yield every version of a batch record, oldest first
+def iter_batch_versions(stream_name, batch_key):
+    # Retrieve every full record and every event for the batch in one round trip
+    record_result, events_result = connect_to_multichain_batch([
+        ('liststreamkeyitems', [stream_name, batch_key, False, _ALL_ITEMS, 0]),
+        ('liststreamkeyitems', [stream_name, batch_events.events_key(batch_key), False, _ALL_ITEMS, 0])
+    ])
+
+    event_items = events_result.get('result') or []
+    listed_txids = {item.get('txid') for item in event_items}
+
+    # Full records that are not also listed under the events key were published before
+    # the event log; batches written then republished one per change
+    batch_record = None
+    for item in record_result.get('result') or []:
+        if item.get('txid') not in listed_txids:
+            batch_record = record_codec.decode_record(_item_data(item))
+            yield batch_record
+
+    # The events key lists the remaining full records and the events in stream order; each
+    # full record replaces the batch and each event produces a new version on top of it
+    for item in event_items:
+        if batch_key in (item.get('keys') or []):
+            batch_record = record_codec.decode_record(_item_data(item))
+        elif batch_record is not None:
+            batch_record = batch_events.apply_event(batch_record, record_codec.decode_record(_item_data(item)))
+        else:
+            continue
+        yield batch_record
+
 def create_batch_record(batch_key, manufacture_date, expiration_date):
     # Create initial batch JSON
     batch_data = {
@@ -197,7 +418,8 @@ def create_batch_record(batch_key, manufacture_date, expiration_date):
     }
 
     # Publish the initial batch record to the blockchain
-    result = publish_json_to_blockchain("root", batch_key, batch_data)
+    # It is listed under the events key as well, so events published before it are not applied to it
+    result = publish_json_to_blockchain("root", batch_events.record_keys(batch_key), batch_data)
     return result
 
 def append_qc_test(batch_key, test_name, test_result, test_hash):
@@ -212,11 +434,8 @@ def append_qc_test(batch_key, test_name, test_result, test_hash):
             "test_hash": test_hash
         }
 
-        # Append the new test result and hash to the qc_tests list
-        existing_json['qc_tests'].append(qc_entry)
-
-        # Republish the updated batch record with the appended QC test
-        publish_json_to_blockchain("root", batch_key, existing_json)
+        # Publish only the new test result and hash as an event on the batch
+        publish_batch_event("root", batch_key, 'qc_test', qc_entry)
         print("QC test result and hash appended successfully.")
     else:
         print("No batch data found to update.")
@@ -226,11 +445,13 @@ def update_release_status(batch_key, new_status):
     existing_json = get_latest_json_from_blockchain("root", batch_key)
 
     if existing_json:
-        # Update release status
-        existing_json['release_status'] = new_status
+        # Skip the publish entirely if nothing would change
+        if existing_json.get('release_status') == new_status:
+            print("Release status unchanged; skipping publish.")
+            return
 
-        # Republish the updated batch record
-        publish_json_to_blockchain("root", batch_key, existing_json)
+        # Publish the new release status as an event on the batch
+        publish_batch_event("root", batch_key, 'release_status', new_status)
         print("Release status updated successfully.")
     else:
         print("No batch data found to update.")
@@ -240,11 +461,13 @@ def append_deviation(batch_key, deviation_id):
     existing_json = get_latest_json_from_blockchain("root", batch_key)
 
     if existing_json:
-        # Append new deviation
-        existing_json['deviations'].append(deviation_id)
+        # Do not record the same Deviation twice
+        if deviation_id in existing_json.get('deviations', []):
+            print(f"Deviation {deviation_id} is already recorded for this batch.")
+            return
 
-        # Republish the updated batch record
-        publish_json_to_blockchain("root", batch_key, existing_json)
+        # Publish the new deviation as an event on the batch
+        publish_batch_event("root", batch_key, 'deviation', deviation_id)
         print("Deviation appended successfully.")
     else:
         print("No batch data found to update.")
@@ -253,11 +476,13 @@ def append_capa(batch_key, capa_id):
     existing_json = get_latest_json_from_blockchain("root", batch_key)
 
     if existing_json:
-        # Append new CAPA
-        existing_json['CAPA'].append(capa_id)
+        # Do not record the same CAPA twice
+        if capa_id in existing_json.get('CAPA', []):
+            print(f"CAPA {capa_id} is already recorded for this batch.")
+            return
 
-        # Republish the updated batch record
-        publish_json_to_blockchain("root", batch_key, existing_json)
+        # Publish the new CAPA as an event on the batch
+        publish_batch_event("root", batch_key, 'capa', capa_id)
         print("CAPA appended successfully.")
     else:
         print("No batch data found to update.")
@@ -266,11 +491,13 @@ def append_oos(batch_key, oos_id):
     existing_json = get_latest_json_from_blockchain("root", batch_key)
 
     if existing_json:
-        # Append new OOS investigation
-        existing_json['OOS_investigations'].append(oos_id)
+        # Do not record the same OOS investigation twice
+        if oos_id in existing_json.get('OOS_investigations', []):
+            print(f"OOS investigation {oos_id} is already recorded for this batch.")
+            return
 
-        # Republish the updated batch record
-        publish_json_to_blockchain("root", batch_key, existing_json)
+        # Publish the new OOS investigation as an event on the batch
+        publish_batch_event("root", batch_key, 'oos', oos_id)
         print("OOS investigation appended successfully.")
     else:
         print("No batch data found to update.")
@@ -390,190 +617,187 @@ def get_manufacture_date(batch_key):
 
 def print_human_readable_batch_record(batch_record):
     if batch_record:
-        print(f"Batch Number: {batch_record.get('batch_number', 'N/A')}")
-        print(f"Manufacture Date: {batch_record.get('manufacture_date', 'N/A')}")
-        print(f"Expiration Date: {batch_record.get('expiration_date', 'N/A')}")
-        print(f"Release Status: {batch_record.get('release_status', 'N/A')}")
+        # Collect the output lines and write them in one go rather than printing line by line
+        out = []
+        out.append(f"Batch Number: {batch_record.get('batch_number', 'N/A')}\n")
+        out.append(f"Manufacture Date: {batch_record.get('manufacture_date', 'N/A')}\n")
+        out.append(f"Expiration Date: {batch_record.get('expiration_date', 'N/A')}\n")
+        out.append(f"Release Status: {batch_record.get('release_status', 'N/A')}\n")
         
         # Printing QC Tests
-        print("\nQC Test Results:")
+        out.append("\nQC Test Results:\n")
         if 'qc_tests' in batch_record and batch_record['qc_tests']:
             for test in batch_record['qc_tests']:
-                print(f"  - Test Name: {test.get('test_name', 'N/A')}")
-                print(f"    Result: {test.get('test_result', 'N/A')}")
-                print(f"    Hash: {test.get('test_hash', 'N/A')}")
+                out.append(f"  - Test Name: {test.get('test_name', 'N/A')}\n")
+                out.append(f"    Result: {test.get('test_result', 'N/A')}\n")
+                out.append(f"    Hash: {test.get('test_hash', 'N/A')}\n")
         else:
-            print("  No QC tests have been recorded.")
+            out.append("  No QC tests have been recorded.\n")
         
         # Printing Deviation Records
-        print("\nDeviations:")
+        out.append("\nDeviations:\n")
         if 'deviations' in batch_record and batch_record['deviations']:
             for deviation in batch_record['deviations']:
-                print(f"  - {deviation}")
+                out.append(f"  - {deviation}\n")
         else:
-            print("  No deviations recorded.")
+            out.append("  No deviations recorded.\n")
         
         # Printing CAPA Records
-        print("\nCAPA Records:")
+        out.append("\nCAPA Records:\n")
         if 'CAPA' in batch_record and batch_record['CAPA']:
             for capa in batch_record['CAPA']:
-                print(f"  - {capa}")
+                out.append(f"  - {capa}\n")
         else:
-            print("  No CAPA records found.")
+            out.append("  No CAPA records found.\n")
         
         # Printing OOS Investigations
-        print("\nOOS Investigations:")
+        out.append("\nOOS Investigations:\n")
         if 'OOS_investigations' in batch_record and batch_record['OOS_investigations']:
             for oos in batch_record['OOS_investigations']:
-                print(f"  - {oos}")
+                out.append(f"  - {oos}\n")
         else:
-            print("  No OOS investigations recorded.")
+            out.append("  No OOS investigations recorded.\n")
+
+        sys.stdout.writelines(out)
+        sys.stdout.flush()
     else:
         print("No batch data found.")
 
+# Function to render each version of a batch record as text, one chunk at a time
+def _format_versions(versions):
+    for index, batch_record in enumerate(versions, 1):
+        # The version number followed by the JSON object
+        yield f"\nVersion {index}:\n"
+        yield orjson.dumps(batch_record, option=orjson.OPT_INDENT_2).decode('utf-8')
+        yield '\n'
+
 def get_batch_history(batch_key):
-    # Retrieve all entries associated with the given batch key
-    result = connect_to_multichain('liststreamkeyitems', ['root', batch_key])
-
-    if result and 'result' in result and len(result['result']) > 0:
-        print(f"History of batch {batch_key}:")
-        # Loop through each iteration of the record
-        for index, item in enumerate(result['result'], 1):
-            # Decode the hex data into JSON format
-            json_hex = item['data']
-            json_string = binascii.unhexlify(json_hex).decode('utf-8')
-            batch_record = json.loads(json_string)
-            
-            # Print the version number and the JSON object
-            print(f"\nVersion {index}:")
-            print(json.dumps(batch_record, indent=4))
+    versions = iter_batch_versions('root', batch_key)
+    first_version = next(versions, None)
+
+    if first_version is not None:
+        sys.stdout.write(f"History of batch {batch_key}:\n")
+        # writelines pulls from the generator, so versions are still decoded, written and
+        # discarded one at a time while skipping the per-line overhead of print
+        sys.stdout.writelines(_format_versions(itertools.chain([first_version], versions)))
+        sys.stdout.flush()
     else:
         print(f"No history found for batch {batch_key}.")
         
+# Marker for keys that are missing from the previous version
+_MISSING = object()
+
 def find_changes(old_version, new_version):
     changes = {}
-    for key in new_version:
-        if key not in old_version:
-            changes[key] = {"old": None, "new": new_version[key]}
-        elif old_version[key] != new_version[key]:
-            changes[key] = {"old": old_version[key], "new": new_version[key]}
+    for key, new_value in new_version.items():
+        old_value = old_version.get(key, _MISSING)
+
+        # Unchanged values are usually the very same object, so skip them without comparing
+        if old_value is new_value:
+            continue
+
+        if old_value is _MISSING:
+            changes[key] = {"old": None, "new": new_value}
+        elif isinstance(old_value, list) and isinstance(new_value, list) and len(old_value) != len(new_value):
+            # A length change is a change without walking the elements; since the list
+            # fields are append-only, report the appended tail when the prefix is intact
+            changes[key] = {"old": old_value, "new": new_value}
+            if len(new_value) > len(old_value) and new_value[:len(old_value)] == old_value:
+                changes[key]["added"] = new_value[len(old_value):]
+        elif old_value != new_value:
+            changes[key] = {"old": old_value, "new": new_value}
     return changes
 
 def get_batch_changes(batch_key):
-    # Retrieve all entries associated with the given batch key
-    result = connect_to_multichain('liststreamkeyitems', ['root', batch_key])
-
-    if result and 'result' in result and len(result['result']) > 0:
-        print(f"Changes in batch {batch_key}:")
-        previous_version = None
-
-        # Loop through each iteration of the record
-        for index, item in enumerate(result['result'], 1):
-            # Decode the hex data into JSON format
-            json_hex = item['data']
-            json_string = binascii.unhexlify(json_hex).decode('utf-8')
-            current_version = json.loads(json_string)
-
-            # If there is a previous version, compare and find changes
-            if previous_version is not None:
-                changes = find_changes(previous_version, current_version)
-                if changes:
-                    print(f"\nChanges from Version {index - 1} to Version {index}:")
-                    for key, change in changes.items():
-                        print(f"  - {key}:")
+    previous_version = None
+
+    # Loop through each version of the record, including those produced by events
+    for index, current_version in enumerate(iter_batch_versions('root', batch_key), 1):
+        # If there is a previous version, compare and find changes
+        if previous_version is not None:
+            changes = find_changes(previous_version, current_version)
+            if changes:
+                print(f"\nChanges from Version {index - 1} to Version {index}:")
+                for key, change in changes.items():
+                    print(f"  - {key}:")
+                    if 'added' in change:
+                        print(f"    Added: {change['added']}")
+                    else:
                         print(f"    Old: {change['old']}")
                         print(f"    New: {change['new']}")
-                else:
-                    print(f"\nNo changes from Version {index - 1} to Version {index}.")
             else:
-                print(f"\nInitial Version (Version {index}):")
-                print(json.dumps(current_version, indent=4))
+                print(f"\nNo changes from Version {index - 1} to Version {index}.")
+        else:
+            print(f"Changes in batch {batch_key}:")
+            print(f"\nInitial Version (Version {index}):")
+            print(json.dumps(current_version, indent=4))
 
-            # Set the current version as the previous one for the next comparison
-            previous_version = current_version
-    else:
+        # Set the current version as the previous one for the next comparison
+        previous_version = current_version
+
+    if previous_version is None:
         print(f"No history found for batch {batch_key}.")
 
+# Accepted expiration query formats: 'YYYY', 'YYYY-MM' or 'YYYY-MM-DD'
+_EXPIRATION_INPUT_PATTERN = re.compile(r'[0-9]{4}(-(0[1-9]|1[0-2])(-[0-9]{2})?)?')
+
 def get_batches_by_expiration(expiration_input):
-    # Convert input to datetime format based on the user's input
+    # Validate the input against the accepted formats: year, month-year, or day-month-year
     try:
-        # Try to parse the input in different formats: year, month-year, or day-month-year
-        if len(expiration_input) == 4:  # Year only (e.g., '2026')
-            expiration_target = datetime.strptime(expiration_input, '%Y')
-            check_format = 'year'
-        elif len(expiration_input) == 7:  # Month-Year (e.g., '2026-09')
-            expiration_target = datetime.strptime(expiration_input, '%Y-%m')
-            check_format = 'month'
-        elif len(expiration_input) == 10:  # Day-Month-Year (e.g., '2026-09-23')
-            expiration_target = datetime.strptime(expiration_input, '%Y-%m-%d')
-            check_format = 'day'
-        else:
+        if not _EXPIRATION_INPUT_PATTERN.fullmatch(expiration_input):
             raise ValueError("Invalid date format. Use 'YYYY', 'YYYY-MM', or 'YYYY-MM-DD'.")
+        if len(expiration_input) == 10:  # Day-Month-Year (e.g., '2026-09-23'), check it is a real date
+            date.fromisoformat(expiration_input)
     except ValueError as e:
         print(f"Error parsing date: {e}")
         return
 
-    # Retrieve all entries from the stream ('root' stream)
-    result = connect_to_multichain('liststreamitems', ['root'])
-
-    if result and 'result' in result and len(result['result']) > 0:
-        latest_batches = {}  # Store the latest version of each batch
-
-        # Loop through all items in the stream
-        for item in result['result']:
-            # Decode the hex data into JSON format
-            json_hex = item['data']
-            json_string = binascii.unhexlify(json_hex).decode('utf-8')
-            batch_record = json.loads(json_string)
-
-            # Check if the batch has an expiration_date field
-            if 'expiration_date' in batch_record:
-                # Parse the expiration date from the batch record
-                expiration_date = datetime.strptime(batch_record['expiration_date'], '%Y-%m-%d')
-
-                # Store the latest version of the batch (based on batch number)
-                batch_number = batch_record['batch_number']
-                latest_batches[batch_number] = batch_record
-
-        # Now filter the latest batch versions by the expiration criteria
-        batches_expiring_in_criteria = []
-        for batch_number, batch_record in latest_batches.items():
-            expiration_date = datetime.strptime(batch_record['expiration_date'], '%Y-%m-%d')
-            
-            # Check if the expiration date matches the criteria
-            if check_format == 'year' and expiration_date.year == expiration_target.year:
-                batches_expiring_in_criteria.append(batch_record)
-            elif check_format == 'month' and expiration_date.year == expiration_target.year and expiration_date.month == expiration_target.month:
-                batches_expiring_in_criteria.append(batch_record)
-            elif check_format == 'day' and expiration_date == expiration_target:
-                batches_expiring_in_criteria.append(batch_record)
-
-        # Print out the batches that match the expiration input
-        if batches_expiring_in_criteria:
-            print(f"Batches expiring in {expiration_input}:")
-            for batch in batches_expiring_in_criteria:
-                print(f"  - Batch Number: {batch['batch_number']}, Expiration Date: {batch['expiration_date']}")
-        else:
+    # Bring the local expiration index up to date with any newly published items
+    conn = index_batches.open_index()
+    try:
+        index_batches.refresh_index(conn, connect_to_multichain, rpc_many, connect_to_multichain_batch)
+        if index_batches.count_batches(conn) == 0:
+            print("No batch records found in the blockchain.")
+            return
+
+        # Stream the matching rows straight from the SQLite cursor to stdout
+        rows = index_batches.query_by_expiration(conn, expiration_input)
+        first_row = next(rows, None)
+        if first_row is None:
             print(f"No batches expiring in {expiration_input} were found.")
-    else:
-        print("No batch records found in the blockchain.")
+            return
+
+        sys.stdout.write(f"Batches expiring in {expiration_input}:\n")
+        sys.stdout.writelines(
+            f"  - Batch Number: {batch_number}, Expiration Date: {expiration_date}\n"
+            for batch_number, expiration_date in itertools.chain([first_row], rows)
+        )
+        sys.stdout.flush()
+    finally:
+        conn.close()
+
 def update_expiration_date(batch_key, new_expiration_date):
     # Retrieve the latest batch entry
     existing_json = get_latest_json_from_blockchain("root", batch_key)
 
     if existing_json:
+        # Skip the publish entirely if nothing would change
+        if existing_json.get('expiration_date') == new_expiration_date:
+            print(f"Expiration date for batch {batch_key} is already {new_expiration_date}; skipping publish.")
+            return
+
         try:
-            # Validate the new expiration date format (YYYY-MM-DD)
-            new_expiration_date_parsed = datetime.strptime(new_expiration_date, '%Y-%m-%d')
+            # Validate the new expiration date format (YYYY-MM-DD); the pattern check keeps out
+            # other ISO 8601 spellings such as '20260923' that fromisoformat also accepts
+            if len(new_expiration_date) != 10 or not _EXPIRATION_INPUT_PATTERN.fullmatch(new_expiration_date):
+                raise ValueError(new_expiration_date)
+            date.fromisoformat(new_expiration_date)
         except ValueError:
             print(f"Error: The provided expiration date '{new_expiration_date}' is not in the correct format (YYYY-MM-DD).")
             return
         
-        # Update the expiration date
-        existing_json['expiration_date'] = new_expiration_date
-        
-        # Publish the updated batch record with the new expiration date
-        result = publish_json_to_blockchain("root", batch_key, existing_json)
+        # Publish the new expiration date as an event on the batch
+        result = publish_batch_event("root", batch_key, 'expiration_date', new_expiration_date)
         if result:
             print(f"Expiration date for batch {batch_key} has been successfully updated to {new_expiration_date}.")
         else:
@@ -582,194 +806,75 @@ def update_expiration_date(batch_key, new_expiration_date):
         print(f"No batch data found for key: {batch_key}.")
 
 def list_all_batches():
-    # Retrieve all entries from the stream ('root' stream)
-    result = connect_to_multichain('liststreamitems', ['root'])
-
-    if result and 'result' in result and len(result['result']) > 0:
-        batch_numbers = set()  # Use a set to store unique batch numbers
-
-        # Loop through all items in the stream
-        for item in result['result']:
-            # Decode the hex data into JSON format
-            json_hex = item['data']
-            json_string = binascii.unhexlify(json_hex).decode('utf-8')
-            batch_record = json.loads(json_string)
-
-            # Add the batch number to the set
-            if 'batch_number' in batch_record:
-                batch_numbers.add(batch_record['batch_number'])
-
-        # Output the list of unique batch numbers
-        if batch_numbers:
-            print("List of all unique batches on the blockchain:")
-            for batch_number in batch_numbers:
-                print(f"  - Batch Number: {batch_number}")
-        else:
-            print("No batches found on the blockchain.")
-    else:
+    found_records = False
+    batch_numbers = set()  # Batch numbers already printed
+
+    # Decode, deduplicate and print the latest record of each batch in a single streaming pass
+    for batch_record in iter_latest_records('root'):
+        found_records = True
+        batch_number = batch_record.get('batch_number')
+        if batch_number and batch_number not in batch_numbers:
+            if not batch_numbers:
+                sys.stdout.write("List of all unique batches on the blockchain:\n")
+            batch_numbers.add(batch_number)
+            sys.stdout.write(f"  - Batch Number: {batch_number}\n")
+    sys.stdout.flush()
+
+    if not found_records:
         print("No batch records found in the blockchain.")
+    elif not batch_numbers:
+        print("No batches found on the blockchain.")
 
 
+def append_qc_test_with_file(batch_key, test_name, test_result, file_path):
+    # Use the order-dependent fingerprint of the data file as the test hash
+    fingerprint_dep = data_fingerprint.process_file_with_order_dependent_fingerprint(file_path)
+    append_qc_test(batch_key, test_name, test_result, fingerprint_dep)
+
+def print_full_batch_record(batch_key):
+    print_human_readable_batch_record(get_latest_json_from_blockchain("root", batch_key))
+
+# CLI operations: name -> (number of arguments, handler, usage)
+_OPS = {
+    "create_batch": (3, create_batch_record, "create_batch <batch_key> <manufacture_date> <expiration_date>"),
+    "append_qc_test_with_hash": (4, append_qc_test, "append_qc_test_with_hash <batch_key> <test_name> <test_result> <test_hash>"),
+    "append_qc_test_with_file": (4, append_qc_test_with_file, "append_qc_test_with_file <batch_key> <test_name> <test_result> <file_path>"),
+    "update_release_status": (2, update_release_status, "update_release_status <batch_key> <new_status>"),
+    "update_expiration_date": (2, update_expiration_date, "update_expiration_date <batch_key> <new_expiration_date>"),
+    "get_full_batch_record": (1, get_full_batch_record, "get_full_batch_record <batch_key>"),
+    "get_batch_history": (1, get_batch_history, "get_batch_history <batch_key>"),
+    "list_all_batches": (0, list_all_batches, "list_all_batches"),
+    "get_batches_by_expiration": (1, get_batches_by_expiration, "get_batches_by_expiration <expiration_input (YYYY or YYYY-MM or YYYY-MM-DD)>"),
+    "get_release_status": (1, get_release_status, "get_release_status <batch_key>"),
+    "get_expiration_date": (1, get_expiration_date, "get_expiration_date <batch_key>"),
+    "get_manufacture_date": (1, get_manufacture_date, "get_manufacture_date <batch_key>"),
+    "print_full_batch_record": (1, print_full_batch_record, "print_full_batch_record <batch_key>"),
+    "get_qc_tests": (1, get_qc_tests, "get_qc_tests <batch_key>"),
+    "append_deviation": (2, append_deviation, "append_deviation <batch_key> <deviation_id>"),
+    "append_capa": (2, append_capa, "append_capa <batch_key> <capa_id>"),
+    "append_oos": (2, append_oos, "append_oos <batch_key> <oos_id>"),
+    "get_deviations": (1, get_deviation, "get_deviations <batch_key>"),
+    "get_capa": (1, get_capa, "get_capa <batch_key>"),
+    "get_oos_investigations": (1, get_oos_investigations, "get_oos_investigations <batch_key>"),
+}
+
 def main():
     if len(sys.argv) < 2 or sys.argv[1] in ('-h', '--help'):
         print(HELP_STRING)
         sys.exit(1)
-        
-    operation = sys.argv[1]
 
-    if operation == "create_batch":
-        if len(sys.argv) != 5:
-            print("Usage: create_batch <batch_key> <manufacture_date> <expiration_date>")
-            sys.exit(1)
-        batch_key = sys.argv[2]
-        manufacture_date = sys.argv[3]
-        expiration_date = sys.argv[4]
-        create_batch_record(batch_key, manufacture_date, expiration_date)
-
-    elif operation == "append_qc_test_with_hash":
-        if len(sys.argv) != 6:
-            print("Usage: append_qc_test <batch_key> <test_name> <test_result> <test_hash>")
-            sys.exit(1)
-        batch_key = sys.argv[2]
-        test_name = sys.argv[3]
-        test_result = sys.argv[4]
-        test_hash = sys.argv[5]
-        append_qc_test(batch_key, test_name, test_result, test_hash)
-
-    elif operation == "append_qc_test_with_file":
-        if len(sys.argv) != 6:
-            print("Usage: append_qc_test <batch_key> <test_name> <test_result> <test_hash>")
-            sys.exit(1)
-        batch_key = sys.argv[2]
-        test_name = sys.argv[3]
-        test_result = sys.argv[4]
-        test_hash = sys.argv[5]
-        fingerprint_dep = data_fingerprint.process_file_with_order_dependent_fingerprint(test_hash)
-        append_qc_test(batch_key, test_name, test_result, fingerprint_dep)
-
-    elif operation == "update_release_status":
-        if len(sys.argv) != 4:
-            print("Usage: update_release_status <batch_key> <new_status>")
-            sys.exit(1)
-        batch_key = sys.argv[2]
-        new_status = sys.argv[3]
-        update_release_status(batch_key, new_status)
-
-    elif operation == "update_expiration_date":
-        if len(sys.argv) != 4:
-            print("Usage: update_expiration_date <batch_key> <new_expiration_date>")
-            sys.exit(1)
-        batch_key = sys.argv[2]
-        new_expiration_date = sys.argv[3]
-        update_expiration_date(batch_key, new_expiration_date)
-
-    elif operation == "get_full_batch_record":
-        if len(sys.argv) != 3:
-            print("Usage: get_full_batch_record <batch_key>")
-            sys.exit(1)
-        batch_key = sys.argv[2]
-        get_full_batch_record(batch_key)
-
-    elif operation == "get_batch_history":
-        if len(sys.argv) != 3:
-            print("Usage: get_batch_history <batch_key>")
-            sys.exit(1)
-        batch_key = sys.argv[2]
-        get_batch_history(batch_key)
-
-    elif operation == "list_all_batches":
-        list_all_batches()
-
-    elif operation == "get_batches_by_expiration":
-        if len(sys.argv) != 3:
-            print("Usage: get_batches_by_expiration <expiration_input (YYYY or YYYY-MM or YYYY-MM-DD)>")
-            sys.exit(1)
-        expiration_input = sys.argv[2]
-        get_batches_by_expiration(expiration_input)
-
-    elif operation == "get_release_status":
-        if len(sys.argv) != 3:
-            print("Usage: get_release_status <batch_key>")
-            sys.exit(1)
-        batch_key = sys.argv[2]
-        get_release_status(batch_key)
-
-    elif operation == "get_expiration_date":
-        if len (sys.argv) != 3:
-            print("Useage: get_expiration_date <batch_key>")
-            sys.exit(1)
-        batch_key = sys.argv[2]
-        get_expiration_date(batch_key)
-    
-    elif operation == "get_manufacture_date":
-        if len (sys.argv) != 3:
-            print("Useage: get_manufacture_date <batch_key>")
-            sys.exit(1)
-        batch_key = sys.argv[2]
-        get_manufacture_date(batch_key)
-        
-    elif operation == "print_full_batch_record":
-        if len(sys.argv) != 3:
-            print("Usage: print_full_batch_record <batch_key>")
-            sys.exit(1)
-        batch_key = sys.argv[2]
-        print_human_readable_batch_record(get_latest_json_from_blockchain("root", batch_key))
-
-    elif operation == "get_qc_tests":
-        if len (sys.argv) != 3:
-            print("Useage: get_qc_tests <batch_key>")
-            sys.exit(1)
-        batch_key = sys.argv[2]
-        get_qc_tests(batch_key)
-
-    elif operation == "append_deviation":
-        if len(sys.argv) != 4:
-            print("Usage: append_deviation <batch_key> <dev_number>")
-            sys.exit(1)
-        batch_key = sys.argv[2]
-        deviation_id = sys.argv[3]
-        append_deviation(batch_key, deviation_id)
-
-    elif operation == "append_oos":
-        if len(sys.argv) != 4:
-            print("Usage: append_deviation <batch_key> <dev_number>")
-            sys.exit(1)
-        batch_key = sys.argv[2]
-        oos_id = sys.argv[3]
-        append_oos(batch_key, oos_id)
-
-    elif operation == "append_capa":
-        if len(sys.argv) != 4:
-            print("Usage: append_deviation <batch_key> <dev_number>")
-            sys.exit(1)
-        batch_key = sys.argv[2]
-        capa_id = sys.argv[3]
-        append_capa(batch_key, capa_id)
-        
-    elif operation == "get_deviations":
-        if len (sys.argv) != 3:
-            print("Useage: get_deviations <batch_key>")
-            sys.exit(1)
-        batch_key = sys.argv[2]
-        get_deviation(batch_key)
-        
-    elif operation == "get_oos_investigations":
-        if len (sys.argv) != 3:
-            print("Useage: get_oos_investigations <batch_key>")
-            sys.exit(1)
-        batch_key = sys.argv[2]
-        get_oos_investigations(batch_key)
-
-    elif operation == "get_capa":
-        if len (sys.argv) != 3:
-            print("Useage: get_capa <batch_key>")
-            sys.exit(1)
-        batch_key = sys.argv[2]
-        get_capa(batch_key)
-    
-    else:
+    operation = sys.argv[1]
+    op = _OPS.get(operation)
+    if op is None:
         print(f"Error: Unknown operation '{operation}'.")
         sys.exit(1)
 
+    expected_args, handler, usage = op
+    if len(sys.argv) - 2 != expected_args:
+        print(f"Usage: {usage}")
+        sys.exit(1)
+
+    handler(*sys.argv[2:])
+
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    main()
@@ -0,0 +1,12 @@
+# Gunicorn settings for serving web_app in production:
+#   gunicorn web_app:app
+# Each worker process runs several threads, so a request waiting on the Multichain
+# node does not hold up the others; threads share the worker's pooled RPC session.
+# The app is loaded before forking, so the RPC settings and compiled template are set up
+# once and shared by all workers.
+
+bind = '0.0.0.0:5000'
+workers = 2
+worker_class = 'gthread'
+threads = 8
+preload_app = True
@@ -0,0 +1,140 @@
+"""
+Local SQLite index of batch expiration dates.
+
+The index remembers how far into the stream it has read, so each refresh only
+fetches and decodes the items published since the previous one instead of
+rescanning the whole stream.
+"""
+
+import sqlite3
+import batch_events
+import record_codec
+
+INDEX_PATH = 'batches.sqlite'
+
+# Number of stream items to request per liststreamitems call
+_PAGE_SIZE = 500
+
+# Number of liststreamitems pages requested concurrently during a refresh
+_PAGES_IN_FLIGHT = 16
+
+def open_index(path=INDEX_PATH):
+    """
+    Opens (and creates if needed) the SQLite expiration index.
+    """
+    conn = sqlite3.connect(path)
+    conn.executescript("""
+        CREATE TABLE IF NOT EXISTS batches (
+            batch_number TEXT PRIMARY KEY,
+            expiration_date TEXT,
+            last_txid TEXT
+        );
+        CREATE INDEX IF NOT EXISTS ix_exp ON batches(expiration_date);
+        CREATE TABLE IF NOT EXISTS stream_cursor (
+            stream_name TEXT PRIMARY KEY,
+            position INTEGER NOT NULL
+        );
+    """)
+    return conn
+
+def refresh_index(conn, rpc, rpc_many, rpc_batch, stream_name='root'):
+    """
+    Reads the stream items published since the saved cursor and updates the index.
+    rpc makes a single call, rpc_many runs calls concurrently and rpc_batch sends them as
+    one JSON-RPC batch. Pages are fetched concurrently, _PAGES_IN_FLIGHT at a time.
+    """
+    row = conn.execute('SELECT position FROM stream_cursor WHERE stream_name = ?', (stream_name,)).fetchone()
+    position = row[0] if row else 0
+
+    # Find out how many items the stream holds so every page can be requested up front
+    stream_info = rpc('liststreams', [stream_name])
+    total_items = stream_info['result'][0]['items'] if stream_info and stream_info.get('result') else 0
+
+    latest_rows = {}  # Latest (batch_number, expiration_date, txid) seen per batch
+    cursor_position = position
+    cursor_blocked = False
+
+    page_starts = list(range(position, total_items, _PAGE_SIZE))
+    for window in range(0, len(page_starts), _PAGES_IN_FLIGHT):
+        calls = [
+            ('liststreamitems', [stream_name, False, _PAGE_SIZE, start])
+            for start in page_starts[window:window + _PAGES_IN_FLIGHT]
+        ]
+        items = []
+        for result in rpc_many(calls):
+            if not result or result.get('result') is None:
+                # A page failed; keep the cursor before it so it is retried next time
+                cursor_blocked = True
+                continue
+
+            for item in result['result']:
+                position += 1
+
+                # Only advance the saved cursor over confirmed items; unconfirmed ones
+                # are indexed now but re-read on the next refresh in case they move
+                if item.get('confirmations', 0) > 0 and not cursor_blocked:
+                    cursor_position = position
+                else:
+                    cursor_blocked = True
+                items.append(item)
+
+        # Large items are returned as a reference to the transaction output holding them;
+        # resolve all of the window's references in one batch request. One transaction can
+        # hold several items, so each is identified by its (txid, vout)
+        references = [item['data'] for item in items if isinstance(item['data'], dict) and 'txid' in item['data']]
+        resolved = rpc_batch([('gettxoutdata', [ref['txid'], ref['vout']]) for ref in references]) if references else []
+        large_data = {(ref['txid'], ref['vout']): response.get('result') for ref, response in zip(references, resolved)}
+
+        for item in items:
+            data = item['data']
+            if isinstance(data, dict) and 'txid' in data:
+                data = large_data[(data['txid'], data['vout'])]
+
+            try:
+                batch_record = record_codec.decode_record(data)
+            except (TypeError, ValueError):
+                # Not a batch record (e.g. a bare hash published under another key)
+                continue
+
+            if not isinstance(batch_record, dict):
+                continue
+
+            keys = item.get('keys') or [item.get('key')]
+            if keys[0] and batch_events.is_events_key(keys[0]):
+                # Expiration date changes are published as events on the batch
+                if batch_record.get('op') == 'expiration_date':
+                    batch_number = batch_events.batch_key_of(keys[0])
+                    latest_rows[batch_number] = (batch_number, batch_record['data'], item.get('txid'))
+            elif 'batch_number' in batch_record and 'expiration_date' in batch_record:
+                batch_number = batch_record['batch_number']
+                latest_rows[batch_number] = (batch_number, batch_record['expiration_date'], item.get('txid'))
+
+    # Apply all updates and the new cursor in a single transaction
+    with conn:
+        conn.executemany(
+            'INSERT OR REPLACE INTO batches (batch_number, expiration_date, last_txid) VALUES (?, ?, ?)',
+            latest_rows.values()
+        )
+        conn.execute(
+            'INSERT OR REPLACE INTO stream_cursor (stream_name, position) VALUES (?, ?)',
+            (stream_name, cursor_position)
+        )
+
+def count_batches(conn):
+    """
+    Returns the number of batches held in the index.
+    """
+    return conn.execute('SELECT COUNT(*) FROM batches').fetchone()[0]
+
+def query_by_expiration(conn, expiration_prefix):
+    """
+    Returns a cursor over the (batch_number, expiration_date) rows whose expiration date
+    starts with the given 'YYYY', 'YYYY-MM' or 'YYYY-MM-DD' prefix. Rows are fetched
+    lazily as the cursor is iterated.
+    """
+    # A range on the prefix (rather than LIKE) lets SQLite search ix_exp instead of scanning it
+    return conn.execute(
+        "SELECT batch_number, expiration_date FROM batches "
+        "WHERE expiration_date >= ? AND expiration_date < ? ORDER BY expiration_date",
+        (expiration_prefix, expiration_prefix + '\uffff')
+    )
@@ -0,0 +1,73 @@
+import unittest
+from unittest import mock
+
+import blockchain_qms
+
+
+class FakeStream:
+    """
+    Minimal in-memory stand-in for the node's publish / liststreamkeyitems RPCs.
+    """
+
+    def __init__(self):
+        self.items = []
+
+    def call(self, method, params=None):
+        if method == 'publish':
+            stream_name, key, data = params
+            keys = key if isinstance(key, list) else [key]
+            txid = f'tx{len(self.items)}'
+            self.items.append({'keys': keys, 'data': data, 'txid': txid, 'confirmations': 1})
+            return {'result': txid, 'error': None}
+        if method == 'liststreamkeyitems':
+            key = params[1]
+            count = params[3] if len(params) > 3 else 10
+            start = params[4] if len(params) > 4 else -count
+            items = [item for item in self.items if key in item['keys']]
+            if start < 0:
+                start = max(len(items) + start, 0)
+            return {'result': items[start:start + count], 'error': None}
+        raise ValueError(method)
+
+    def call_batch(self, calls):
+        return [self.call(method, params) for method, params in calls]
+
+
+class RecreatedBatchTest(unittest.TestCase):
+    def setUp(self):
+        self.stream = FakeStream()
+        blockchain_qms._LATEST_CACHE.clear()
+        patches = [
+            mock.patch.object(blockchain_qms, 'connect_to_multichain', self.stream.call),
+            mock.patch.object(blockchain_qms, 'connect_to_multichain_batch', self.stream.call_batch),
+        ]
+        for patch in patches:
+            patch.start()
+            self.addCleanup(patch.stop)
+
+        # Create a batch, change its expiration date, then publish the batch record again
+        blockchain_qms.create_batch_record('B1', '2024-01-01', '2026-01-01')
+        blockchain_qms.publish_batch_event('root', 'B1', 'expiration_date', '2027-05-05')
+        blockchain_qms.create_batch_record('B1', '2024-01-01', '2030-01-01')
+        blockchain_qms.publish_batch_event('root', 'B1', 'release_status', 'Released')
+
+    def test_latest_ignores_events_before_the_latest_record(self):
+        batch_record = blockchain_qms.get_latest_json_from_blockchain('root', 'B1')
+        self.assertEqual(batch_record['expiration_date'], '2030-01-01')
+        self.assertEqual(batch_record['release_status'], 'Released')
+
+    def test_history_follows_stream_order(self):
+        versions = [
+            (version['expiration_date'], version['release_status'])
+            for version in blockchain_qms.iter_batch_versions('root', 'B1')
+        ]
+        self.assertEqual(versions, [
+            ('2026-01-01', 'pending'),
+            ('2027-05-05', 'pending'),
+            ('2030-01-01', 'pending'),
+            ('2030-01-01', 'Released'),
+        ])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,79 @@
+import os
+import sqlite3
+import unittest
+from unittest import mock
+
+# web_app builds the node URL at import; the RPC calls themselves are patched below
+for name in ('RPC_USER', 'RPC_PASSWORD', 'RPC_HOST', 'RPC_PORT'):
+    os.environ.setdefault(name, 'test')
+
+import index_batches
+import record_codec
+import web_app
+
+
+class FakeStream:
+    """
+    Minimal in-memory stand-in for the node's stream listing RPCs. Items larger than
+    maxshowndata are listed as a {txid, vout} reference and fetched with gettxoutdata.
+    """
+
+    def __init__(self):
+        self.items = []
+        self.outputs = {}
+
+    def add_large_item(self, key, record, txid, vout):
+        self.outputs[(txid, vout)] = record_codec.encode_record(record)
+        self.items.append({
+            'keys': [key],
+            'data': {'txid': txid, 'vout': vout, 'size': 100000},
+            'txid': txid,
+            'vout': vout,
+            'confirmations': 1
+        })
+
+    def call(self, method, params=None):
+        if method == 'liststreams':
+            return {'result': [{'name': params[0], 'items': len(self.items)}], 'error': None}
+        if method == 'liststreamitems':
+            count, start = params[2], params[3]
+            return {'result': self.items[start:start + count], 'error': None}
+        if method == 'gettxoutdata':
+            return {'result': self.outputs[tuple(params)], 'error': None}
+        raise ValueError(method)
+
+    def call_batch(self, calls):
+        return [self.call(method, params) for method, params in calls]
+
+
+class SharedTransactionTest(unittest.TestCase):
+    def setUp(self):
+        # Two large items published in one transaction (e.g. through publishmulti)
+        self.stream = FakeStream()
+        self.stream.add_large_item('B1', {'batch_number': 'B1', 'expiration_date': '2026-01-01'}, 'T', 0)
+        self.stream.add_large_item('B2', {'batch_number': 'B2', 'expiration_date': '2027-02-02'}, 'T', 1)
+
+    def test_web_listing_resolves_each_output(self):
+        web_app._parse_item.cache_clear()
+        with mock.patch.object(web_app, 'connect_to_multichain', self.stream.call), \
+                mock.patch.object(web_app, 'rpc_batch', self.stream.call_batch):
+            batches = web_app.load_all_batches()
+
+        self.assertEqual(
+            {batch_number: batch['expiration_date'] for batch_number, batch in batches.items()},
+            {'B1': '2026-01-01', 'B2': '2027-02-02'}
+        )
+
+    def test_expiration_index_resolves_each_output(self):
+        conn = index_batches.open_index(':memory:')
+        self.addCleanup(conn.close)
+        index_batches.refresh_index(conn, self.stream.call, self.stream.call_batch, self.stream.call_batch)
+
+        self.assertEqual(
+            conn.execute('SELECT batch_number, expiration_date FROM batches ORDER BY batch_number').fetchall(),
+            [('B1', '2026-01-01'), ('B2', '2027-02-02')]
+        )
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,24 +1,43 @@
-from flask import Flask, render_template
+from flask import Flask, Response
 import os
+import time
+import threading
+import orjson
 import requests
-import json
-import binascii
+import batch_events
+import record_codec
 from dotenv import load_dotenv
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 
-app = Flask(__name__)
+# Load the RPC settings once at import; the URL never changes while the app runs
+load_dotenv('blockchain.env')
+_RPC_URL = f'http://{os.environ["RPC_USER"]}:{os.environ["RPC_PASSWORD"]}@{os.environ["RPC_HOST"]}:{os.environ["RPC_PORT"]}'
+
+# Number of RPC calls rpc_many keeps in flight; matches the connection pool size
+_RPC_WORKERS = 10
+
+# Shared HTTP session so every RPC call, across requests and threads, reuses pooled keep-alive connections
+# Only failures to connect are retried; RPCs are POSTs, which urllib3 does not re-send once
+# the request may have reached the node
+_SESSION = requests.Session()
+_SESSION.mount('http://', HTTPAdapter(
+    pool_connections=10,
+    pool_maxsize=_RPC_WORKERS,
+    max_retries=Retry(total=3, backoff_factor=0.1)
+))
+_SESSION.headers.update({'content-type': 'application/json'})
+
+# Function to post a JSON-RPC payload and parse the reply straight from the raw response bytes,
+# without first buffering the body into Response.content and decoding it to a str
+def _post_rpc(payload):
+    with _SESSION.post(_RPC_URL, json=payload, stream=True) as response:
+        return orjson.loads(response.raw.read(decode_content=True))
 
 # Function to connect to a Multichain node
 def connect_to_multichain(method, params=None):
-    # Load environment variables from .env file
-    load_dotenv('blockchain.env')
-    rpc_user = os.getenv('RPC_USER')
-    rpc_password = os.getenv('RPC_PASSWORD')
-    rpc_host = os.getenv('RPC_HOST')
-    rpc_port = os.getenv('RPC_PORT')
-
-    # Construct the URL for the RPC connection
-    url = f'http://{rpc_user}:{rpc_password}@{rpc_host}:{rpc_port}'
-    headers = {'content-type': 'application/json'}
     payload = {
         "method": method,
         "params": params if params else [],
@@ -26,34 +45,200 @@ def connect_to_multichain(method, params=None):
         "id": 1
     }
 
-    response = requests.post(url, data=json.dumps(payload), headers=headers)
-    return response.json()
+    return _post_rpc(payload)
+
+# Function to send several RPC calls to the node in a single JSON-RPC batch request
+def rpc_batch(calls):
+    if not calls:
+        return []
+
+    payload = [
+        {"method": method, "params": params if params else [], "jsonrpc": "2.0", "id": i}
+        for i, (method, params) in enumerate(calls)
+    ]
+
+    results = _post_rpc(payload)
+    if not isinstance(results, list):
+        # The node rejected the batch as a whole, so issue the calls individually
+        return rpc_many(calls)
+
+    # The node may answer a batch in any order, so line the responses up by id
+    return sorted(results, key=lambda r: r['id'])
+
+# Function to run several RPC calls concurrently over the shared session, preserving order
+def rpc_many(calls):
+    with ThreadPoolExecutor(max_workers=_RPC_WORKERS) as executor:
+        futures = [executor.submit(connect_to_multichain, method, params) for method, params in calls]
+        return [future.result() for future in futures]
 
-# Retrieve all unique batches with their latest version
+# Number of stream items requested per liststreamitems page
+_PAGE_SIZE = 500
+
+# Seconds a listing of the batches is reused before the stream is read again
+_BATCHES_TTL = 15
+
+# (monotonic time it was loaded, batches, batches serialized as JSON) of the last listing, or None
+_batches_cache = None
+_batches_cache_lock = threading.Lock()
+
+# Function to return the cached listing entry, reloading it from the stream once it has expired
+def _cached_listing():
+    global _batches_cache
+    cached = _batches_cache
+    if cached is not None and time.monotonic() - cached[0] < _BATCHES_TTL:
+        return cached
+
+    # Only one thread reloads an expired listing; the others wait and reuse its result
+    with _batches_cache_lock:
+        cached = _batches_cache
+        if cached is not None and time.monotonic() - cached[0] < _BATCHES_TTL:
+            return cached
+
+        batches = load_all_batches()
+        # Serialize once per load so API requests just send the stored bytes
+        cached = (time.monotonic(), batches, orjson.dumps(batches))
+        _batches_cache = cached
+        return cached
+
+# Retrieve all unique batches with their latest version, keyed by batch number, reusing a
+# recent listing if there is one
 def get_all_batches():
-    result = connect_to_multichain('liststreamitems', ['root'])
+    return _cached_listing()[1]
+
+# Retrieve the same listing as get_all_batches, already serialized as JSON bytes
+def get_all_batches_json():
+    return _cached_listing()[2]
+
+# Drop the cached listing so the next request reads the stream again
+def clear_batches_cache():
+    global _batches_cache
+    _batches_cache = None
+
+# Number of decoded stream items kept in memory between listings
+_PARSED_ITEMS_CACHE_SIZE = 4096
+
+# Items with more hex characters than this are decoded on every listing instead of cached.
+# The cache keys hold the hex, so this caps them at 4096 x 8 KiB = 32 MiB.
+_PARSED_ITEM_MAX_HEX = 8 * 1024
+
+# Function to decode the hex data of a stream item, or None if it is not a record
+def _decode_item(data_hex):
+    try:
+        return record_codec.decode_record(data_hex)
+    except (TypeError, ValueError):
+        # Not a batch record (e.g. a bare hash published under its own key)
+        return None
+
+# Memoized _decode_item. Published items never change, so each one is decoded once and
+# reused by later listings; the data is part of the key so items sharing a transaction
+# cannot be mixed up. The returned records are shared and must not be modified
+# (batch_events.fold_events copies before changing).
+@lru_cache(maxsize=_PARSED_ITEMS_CACHE_SIZE)
+def _parse_item(txid, data_hex):
+    return _decode_item(data_hex)
+
+# Function to decode the record held by a stream item, or None if it is not a record.
+# large_data maps the (txid, vout) of oversized items to their data fetched with gettxoutdata;
+# one transaction can hold several items, so the txid alone does not identify one.
+def _item_record(item, large_data):
+    data = item['data']
+    if isinstance(data, dict) and 'txid' in data:
+        data = large_data[(data['txid'], data['vout'])]
+    if not isinstance(data, str):
+        # JSON and text items ({"json": ...} / {"text": ...}) are not batch records
+        return None
+    if len(data) > _PARSED_ITEM_MAX_HEX:
+        return _decode_item(data)
+    return _parse_item(item.get('txid'), data)
+
+# Read every unique batch with its latest version from the stream, keyed by batch number
+def load_all_batches():
+    # liststreamitems only returns the last 10 items by default, so read the item count
+    # and request every page of the stream in a single batch request
+    info = connect_to_multichain('liststreams', ['root'])
+    total_items = info['result'][0]['items'] if info and info.get('result') else 0
+    pages = rpc_batch([
+        ('liststreamitems', ['root', False, _PAGE_SIZE, start])
+        for start in range(0, total_items, _PAGE_SIZE)
+    ])
+    items = [item for page in pages if page.get('result') for item in page['result']]
     latest_batches = {}
 
-    if result and 'result' in result:
-        for item in result['result']:
-            json_hex = item['data']
-            json_string = binascii.unhexlify(json_hex).decode('utf-8')
-            batch_record = json.loads(json_string)
+    if items:
+        # Walk the stream newest first so only the latest full record under each key, and
+        # the events published after it, are picked; older revisions are never decoded
+        latest_items = {}
+        newer_events = {}
+        # This loop touches every item in the stream, so the events-key test is done inline
+        # (same as batch_events.is_events_key / batch_key_of) and no list is built per item
+        events_suffix = batch_events.EVENTS_KEY_SUFFIX
+        suffix_len = len(events_suffix)
+        for item in reversed(items):
+            keys = item.get('keys')
+            key = keys[0] if keys else item.get('key')
+            if not key:
+                continue
+            if key.endswith(events_suffix):
+                batch_key = key[:-suffix_len]
+                if batch_key not in latest_items:
+                    newer_events.setdefault(batch_key, []).append(item)
+            elif key not in latest_items:
+                latest_items[key] = item
+
+        # Events of batches without a full record have nothing to apply to
+        wanted = list(latest_items.values())
+        for key in latest_items:
+            wanted.extend(newer_events.get(key, ()))
+
+        # Items larger than the node's maxshowndata setting are returned as a reference;
+        # fetch all of them in one batch request rather than one round trip at a time
+        references = [item['data'] for item in wanted if isinstance(item['data'], dict) and 'txid' in item['data']]
+        resolved = rpc_batch([('gettxoutdata', [ref['txid'], ref['vout']]) for ref in references])
+        large_data = {(ref['txid'], ref['vout']): response['result'] for ref, response in zip(references, resolved)}
+
+        # Keep the oldest-first order of the stream in the listing
+        for key, item in reversed(latest_items.items()):
+            batch_record = _item_record(item, large_data)
+            if not isinstance(batch_record, dict) or 'batch_number' not in batch_record:
+                continue
+
+            # Fold incremental changes, oldest first, into the latest version of the batch
+            events = [_item_record(event, large_data) for event in reversed(newer_events.get(key, ()))]
+            events = [event for event in events if isinstance(event, dict)]
+            # Records are visited oldest first, so if two keys carry the same batch number
+            # the newer record overwrites the older one
+            latest_batches[batch_record['batch_number']] = batch_events.fold_events(batch_record, events)
+
+    # Return the latest version of each batch, keyed by batch number
+    return latest_batches
+
+# Build the Flask app. The RPC settings, session and caches above are created at import,
+# so with gunicorn's preload_app they are set up once and shared by the forked workers.
+def create_app():
+    app = Flask(__name__)
+
+    # Templates never change while the app runs, so load the homepage template once and skip
+    # the per-request lookup and modification check
+    app.config['TEMPLATES_AUTO_RELOAD'] = False
+    app.jinja_env.auto_reload = False
+    index_template = app.jinja_env.get_template('index.html')
+
+    # Flask route for the homepage
+    @app.route('/')
+    def index():
+        batches = get_all_batches()
+        return index_template.render(batches=batches)
 
-            if 'batch_number' in batch_record:
-                batch_number = batch_record['batch_number']
-                # Always overwrite the batch entry to keep the latest version
-                latest_batches[batch_number] = batch_record
+    # JSON API serving the batch listing for clients that render it themselves
+    @app.route('/api/batches')
+    def api_batches():
+        return Response(get_all_batches_json(), mimetype='application/json')
 
-    # Return only the latest version of each batch
-    return list(latest_batches.values())
+    return app
 
-# Flask route for the homepage
-@app.route('/')
-def index():
-    batches = get_all_batches()
-    return render_template('index.html', batches=batches)
+# App instance served by gunicorn (web_app:app, see gunicorn.conf.py)
+app = create_app()
 
-# Run the Flask app
+# Run the Flask development server on localhost for local testing
 if __name__ == '__main__':
-    app.run(debug=False, host='0.0.0.0')
+    app.run()